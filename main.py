@@ -5,15 +5,25 @@ Runs both the API server and Telegram bot for Railway deployment
 
 import json
 import os
+import hmac
+import hashlib
 import logging
 import threading
+import time
 import asyncio
+import atexit
 import re
 import random
-import string
+import secrets
+import base64
+import itertools
+import orjson
+from collections import deque
+from contextlib import ExitStack, contextmanager
 from datetime import datetime, timezone
 from functools import wraps
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
 from telegram import Update, Bot, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Application, CommandHandler, ContextTypes, CallbackQueryHandler, MessageHandler, filters
@@ -23,19 +33,56 @@ BOT_TOKEN = os.getenv("BOT_TOKEN", "8282351962:AAFXNMRR2_0Y1z4lTkvwwD_9EXzINPVI5
 OWNER_ID = int(os.getenv("OWNER_ID", "7173346586"))
 OWNER_USERNAME = "@Xeeznk"
 WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "pluxo_secret_2024")
+WEBHOOK_SECRET_BYTES = WEBHOOK_SECRET.encode("utf-8")
 PORT = int(os.getenv("PORT", 5000))
 
+# API paths served without the webhook secret
+OPEN_API_PATHS = {"/api/products"}
+
 # Data files
 DATA_DIR = "bot_data"
 ADMINS_FILE = os.path.join(DATA_DIR, "admins.json")
 BALANCES_FILE = os.path.join(DATA_DIR, "balances.json")
 PURCHASES_FILE = os.path.join(DATA_DIR, "purchases.json")
-LOGS_FILE = os.path.join(DATA_DIR, "action_logs.json")
+LOGS_FILE = os.path.join(DATA_DIR, "action_logs.jsonl")
+LEGACY_LOGS_FILE = os.path.join(DATA_DIR, "action_logs.json")
+LOGS_MAX_ENTRIES = 1000
+LOGS_ROTATE_AT = 2000
 SHOP_PRODUCTS_FILE = "shop_products.json"
 GAMES_FILE = os.path.join(DATA_DIR, "games.json")
 
 SYSTEM_LOCKED = False
-GAMES_LOCK = threading.Lock()
+# Lock order: game lock first, then user_locks() stripes
+DICE_LOCK = threading.Lock()
+BLACKJACK_LOCK = threading.Lock()
+USER_LOCK_STRIPES = 64
+USER_LOCKS = [threading.Lock() for _ in range(USER_LOCK_STRIPES)]
+LOGS_LOCK = threading.Lock()
+_log_line_count = None
+_TX_STATE = threading.local()
+_NOW_CACHE = threading.local()  # (epoch ms, ISO string) of the last now_iso() call
+# Balance/game saves are queued here and written by state_writer()
+DEFERRED_FILES = {BALANCES_FILE, GAMES_FILE}
+FLUSH_DELAY = 0.1
+_DIRTY = {}  # filepath -> (data, pretty)
+_DIRTY_LOCK = threading.Lock()
+_DIRTY_EVENT = threading.Event()
+_BALANCES_CACHE = None  # Authoritative balances, loaded once
+_STATE_CACHE = None  # Authoritative games state, loaded once
+HISTORY_KEYS = ("dice_history", "blackjack_history")
+HISTORY_LIMIT = 100
+# In-memory lookups over the open games lists (never persisted)
+OPEN_GAME_KEYS = ("dice_bets", "blackjack_matches")
+_GAME_INDEX = {key: {} for key in OPEN_GAME_KEYS}  # game id -> game dict
+_WAITING_BY_CREATOR = {key: {} for key in OPEN_GAME_KEYS}  # creator -> waiting game id
+# Games ETag: per-boot epoch plus a version bumped on every save (next() is atomic under the GIL)
+GAMES_EPOCH = secrets.token_hex(4)
+_GAMES_VERSIONS = itertools.count(1)
+_games_version = 0
+_PRODUCTS_PAYLOAD = None  # (file signature, JSON body, ETag) for GET /api/products
+_SHOP_CATALOG = None  # (file signature, products list, set of product keys)
+BOT_LOOP = None  # Event loop of the Telegram bot thread, set by run_bot()
+TG_BOT = None  # Initialized Bot of the running Application, bound to BOT_LOOP
 
 # ==================== LOGGING ====================
 logging.basicConfig(
@@ -52,6 +99,12 @@ def ensure_data_dir():
 def load_json(filepath, default=None):
     if default is None:
         default = {}
+    pending = getattr(_TX_STATE, 'pending', None)
+    if pending and filepath in pending:
+        return pending[filepath][0]
+    dirty = _DIRTY.get(filepath)
+    if dirty is not None:
+        return dirty[0]
     try:
         if os.path.exists(filepath):
             with open(filepath, 'r', encoding='utf-8') as f:
@@ -60,16 +113,95 @@ def load_json(filepath, default=None):
         logger.error(f"Error loading {filepath}: {e}")
     return default
 
-def save_json(filepath, data):
+def save_json(filepath, data, pretty=False):
+    """Persist data as JSON; pretty=True only for files people edit by hand."""
+    pending = getattr(_TX_STATE, 'pending', None)
+    if pending is not None:
+        pending[filepath] = (data, pretty)
+        return True
+    if filepath in DEFERRED_FILES:
+        with _DIRTY_LOCK:
+            _DIRTY[filepath] = (data, pretty)
+        _DIRTY_EVENT.set()
+        return True
+    return write_json(filepath, data, pretty)
+
+def _json_default(obj):
+    """Encode the in-memory containers (bounded history deques) as JSON arrays."""
+    if isinstance(obj, deque):
+        return list(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+def dump_json(data, pretty=False):
+    """Serialize data to UTF-8 JSON bytes (compact unless pretty)."""
+    return orjson.dumps(data, default=_json_default, option=orjson.OPT_INDENT_2 if pretty else 0)
+
+def atomic_write_bytes(filepath, payload):
+    """Replace filepath with payload so readers never see a half-written file."""
+    tmp = f"{filepath}.tmp.{os.getpid()}.{threading.get_ident()}"
+    try:
+        with open(tmp, 'wb') as f:
+            f.write(payload)
+        os.replace(tmp, filepath)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+def write_json(filepath, data, pretty=False):
+    """Write data to disk immediately."""
     ensure_data_dir()
     try:
-        with open(filepath, 'w', encoding='utf-8') as f:
-            json.dump(data, f, indent=2, ensure_ascii=False)
+        # Serialize up front so the file is written with one write() call
+        atomic_write_bytes(filepath, dump_json(data, pretty))
         return True
     except Exception as e:
         logger.error(f"Error saving {filepath}: {e}")
         return False
 
+def flush_dirty():
+    """Write every deferred file that is waiting for the state writer."""
+    with _DIRTY_LOCK:
+        batch = list(_DIRTY.items())
+    for filepath, entry in batch:
+        try:
+            ok = write_json(filepath, *entry)
+        except RuntimeError as e:  # Mutated mid-encode by a request thread; retry next round
+            logger.warning(f"Deferred save of {filepath} retried: {e}")
+            _DIRTY_EVENT.set()
+            continue
+        if ok:
+            with _DIRTY_LOCK:
+                # Keep it queued if it was saved again while we were writing
+                if _DIRTY.get(filepath) is entry:
+                    del _DIRTY[filepath]
+
+def state_writer():
+    """Coalesce bursts of balance/game saves into one write per file every FLUSH_DELAY seconds."""
+    while True:
+        _DIRTY_EVENT.wait()
+        time.sleep(FLUSH_DELAY)
+        _DIRTY_EVENT.clear()
+        flush_dirty()
+
+@contextmanager
+def transaction():
+    """Defer save_json() inside the block and write each touched file once on exit.
+
+    Nothing is written if the block raises. Yields the pending writes so a
+    caller can clear() them to abandon the changes.
+    """
+    if getattr(_TX_STATE, 'pending', None) is not None:
+        yield _TX_STATE.pending
+        return
+    pending = _TX_STATE.pending = {}
+    try:
+        yield pending
+    finally:
+        _TX_STATE.pending = None
+    for filepath, (data, pretty) in pending.items():
+        save_json(filepath, data, pretty)
+
 def load_admins():
     data = load_json(ADMINS_FILE, {"admins": [OWNER_ID]})
     admins = set(data.get("admins", [OWNER_ID]))
@@ -80,12 +212,18 @@ def save_admins(admin_set):
     admin_list = list(admin_set)
     if OWNER_ID not in admin_list:
         admin_list.insert(0, OWNER_ID)
-    save_json(ADMINS_FILE, {"admins": admin_list})
+    save_json(ADMINS_FILE, {"admins": admin_list}, pretty=True)
 
 def load_balances():
-    return load_json(BALANCES_FILE, {})
+    """Return the in-memory balances dict, reading the file only the first time."""
+    global _BALANCES_CACHE
+    if _BALANCES_CACHE is None:
+        _BALANCES_CACHE = load_json(BALANCES_FILE, {})
+    return _BALANCES_CACHE
 
 def save_balances(balances):
+    global _BALANCES_CACHE
+    _BALANCES_CACHE = balances
     save_json(BALANCES_FILE, balances)
 
 def load_purchases():
@@ -94,22 +232,55 @@ def load_purchases():
 def save_purchases(purchases):
     save_json(PURCHASES_FILE, purchases)
 
+def _count_log_lines():
+    """Count entries in the action log, importing the legacy JSON log once."""
+    if not os.path.exists(LOGS_FILE) and os.path.exists(LEGACY_LOGS_FILE):
+        legacy = load_json(LEGACY_LOGS_FILE, {"logs": []}).get("logs", [])
+        with open(LOGS_FILE, 'wb') as f:
+            for entry in legacy[-LOGS_MAX_ENTRIES:]:
+                f.write(dump_json(entry) + b"\n")
+    try:
+        with open(LOGS_FILE, 'rb') as f:
+            return sum(1 for _ in f)
+    except FileNotFoundError:
+        return 0
+
+def rotate_logs():
+    """Trim the action log to the newest LOGS_MAX_ENTRIES lines."""
+    global _log_line_count
+    with open(LOGS_FILE, 'rb') as f:
+        tail = deque(f, maxlen=LOGS_MAX_ENTRIES)
+    atomic_write_bytes(LOGS_FILE, b"".join(tail))
+    _log_line_count = len(tail)
+
 def log_action(admin_id, admin_name, action, details=""):
-    logs = load_json(LOGS_FILE, {"logs": []})
-    logs["logs"].append({
-        "timestamp": datetime.now(timezone.utc).isoformat(),
+    """Append one entry to the action log; compaction is amortized over LOGS_ROTATE_AT appends."""
+    global _log_line_count
+    entry = {
+        "timestamp": now_iso(),
         "admin_id": admin_id,
         "admin_name": admin_name,
         "action": action,
         "details": details
-    })
-    logs["logs"] = logs["logs"][-1000:]
-    save_json(LOGS_FILE, logs)
+    }
+    line = dump_json(entry) + b"\n"
+    ensure_data_dir()
+    with LOGS_LOCK:
+        try:
+            if _log_line_count is None:
+                _log_line_count = _count_log_lines()
+            with open(LOGS_FILE, 'ab') as f:
+                f.write(line)
+            _log_line_count += 1
+            if _log_line_count > LOGS_ROTATE_AT:
+                rotate_logs()
+        except Exception as e:
+            logger.error(f"Error writing {LOGS_FILE}: {e}")
 
 def generate_key(length=16):
-    """Generate a random alphanumeric key"""
-    chars = string.ascii_uppercase + string.digits
-    return ''.join(random.choice(chars) for _ in range(length))
+    """Generate a random alphanumeric key (base32: A-Z, 2-7)"""
+    raw = secrets.token_bytes((length * 5 + 7) // 8)
+    return base64.b32encode(raw).decode('ascii').rstrip('=')[:length]
 
 def parse_bulk_cards(text: str):
     """Parse bulk pipe-delimited cards (card|mm|yyyy|cvv)"""
@@ -124,14 +295,11 @@ def parse_bulk_cards(text: str):
         # Match: 5355851164846467|02|2026|358
         match = re.match(r'^(\d{15,16})\|(\d{1,2})\|(\d{4})\|(\d{3,4})$', line)
         if match:
-            card_number = match.group(1)
+            card_number = match.group(1).rjust(16, '0')
             exp_month = match.group(2).zfill(2)
             exp_year = match.group(3)
             cvv = match.group(4)
             
-            if len(card_number) == 15:
-                card_number = '0' + card_number
-            
             cards.append({
                 'card_number': card_number,
                 'exp_month': exp_month,
@@ -161,7 +329,7 @@ def parse_multiline_cards(text: str):
         # Match: 4145670692391812 01/29 651
         match = re.match(r'^(\d{15,16})\s+(\d{2})/(\d{2})\s+(\d{3,4})$', line)
         if match:
-            card_number = match.group(1)
+            card_number = match.group(1).rjust(16, '0')
             exp_month = match.group(2)
             exp_year_short = match.group(3)
             cvv = match.group(4)
@@ -169,9 +337,6 @@ def parse_multiline_cards(text: str):
             # Convert 2-digit year to 4-digit
             exp_year = '20' + exp_year_short
             
-            if len(card_number) == 15:
-                card_number = '0' + card_number
-            
             # Get next 4 lines for address info
             name = lines[i + 1].strip() if i + 1 < len(lines) else ''
             address = lines[i + 2].strip() if i + 2 < len(lines) else ''
@@ -213,27 +378,68 @@ def parse_all_formats(text: str):
     
     return []
 
+BRAND_BY_FIRST_DIGIT = {"3": "AMEX", "4": "VISA", "5": "MASTERCARD"}
+
 def get_brand_from_bin(bin_str):
     """Determine card brand from BIN"""
     if not bin_str or len(bin_str) < 6:
         return "VISA"
-    first_digit = bin_str[0]
-    if first_digit == "4":
-        return "VISA"
-    elif first_digit == "5":
-        return "MASTERCARD"
-    elif first_digit == "3":
-        return "AMEX"
-    return "VISA"
+    return BRAND_BY_FIRST_DIGIT.get(bin_str[0], "VISA")
+
+def file_signature(filepath):
+    """Return (mtime_ns, size) of filepath, or None if it does not exist."""
+    try:
+        st = os.stat(filepath)
+    except FileNotFoundError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+def index_keys(shop_products):
+    return {p.get('key', '') for p in shop_products}
+
+def get_shop_catalog():
+    """Return (products, keys) of the shop, re-reading and re-indexing only when the file changes."""
+    global _SHOP_CATALOG
+    pending = getattr(_TX_STATE, 'pending', None)
+    if pending and SHOP_PRODUCTS_FILE in pending:
+        shop_products = pending[SHOP_PRODUCTS_FILE][0]
+        return shop_products, index_keys(shop_products)
+    signature = file_signature(SHOP_PRODUCTS_FILE)
+    cached = _SHOP_CATALOG
+    if cached is None or cached[0] != signature:
+        shop_products = load_json(SHOP_PRODUCTS_FILE, [])
+        if not isinstance(shop_products, list):
+            shop_products = []
+        cached = _SHOP_CATALOG = (signature, shop_products, index_keys(shop_products))
+    return cached[1], cached[2]
 
 def get_shop_products():
     """Load shop products as a normalized list."""
-    shop_products = load_json(SHOP_PRODUCTS_FILE, [])
-    return shop_products if isinstance(shop_products, list) else []
+    return get_shop_catalog()[0]
+
+def save_shop_products(shop_products, keys=None):
+    """Persist shop products to shared storage; pass keys when the caller kept the index current."""
+    global _SHOP_CATALOG
+    _SHOP_CATALOG = None
+    if save_json(SHOP_PRODUCTS_FILE, shop_products, pretty=True) and getattr(_TX_STATE, 'pending', None) is None:
+        # Written through: keep the catalog warm instead of re-parsing our own write
+        _SHOP_CATALOG = (
+            file_signature(SHOP_PRODUCTS_FILE),
+            shop_products,
+            keys if keys is not None else index_keys(shop_products),
+        )
 
-def save_shop_products(shop_products):
-    """Persist shop products to shared storage."""
-    save_json(SHOP_PRODUCTS_FILE, shop_products)
+def get_products_payload():
+    """Return the serialized catalog and its ETag, re-encoding only when the file changes."""
+    global _PRODUCTS_PAYLOAD
+    signature = file_signature(SHOP_PRODUCTS_FILE)
+    cached = _PRODUCTS_PAYLOAD
+    if cached is not None and cached[0] == signature:
+        return cached[1], cached[2]
+    body = dump_json(get_shop_products())
+    etag = hashlib.blake2b(body, digest_size=8).hexdigest()
+    _PRODUCTS_PAYLOAD = (signature, body, etag)
+    return body, etag
 
 def clear_shop_products():
     """Clear all shop stock and return removed count."""
@@ -279,14 +485,13 @@ def remove_shop_products_by_slots(slot_numbers):
     if not isinstance(slot_numbers, list):
         return [], []
 
-    normalized_slots = []
+    normalized_slots = {}  # dict keeps first-seen order while de-duplicating in O(1)
     for slot in slot_numbers:
         try:
-            slot_int = int(slot)
-            if slot_int not in normalized_slots:
-                normalized_slots.append(slot_int)
+            normalized_slots.setdefault(int(slot))
         except (TypeError, ValueError):
             continue
+    normalized_slots = list(normalized_slots)
 
     if not normalized_slots:
         return [], []
@@ -302,17 +507,8 @@ def remove_shop_products_by_slots(slot_numbers):
         return [], invalid_slots
 
     slot_set = set(valid_slots)
-    removed_entries = []
-    remaining_products = []
-
-    for idx, product in enumerate(shop_products, start=1):
-        if idx in slot_set:
-            removed_entries.append({
-                "slot": idx,
-                "product": product
-            })
-        else:
-            remaining_products.append(product)
+    removed_entries = [{"slot": idx, "product": shop_products[idx - 1]} for idx in sorted(slot_set)]
+    remaining_products = [product for idx, product in enumerate(shop_products, start=1) if idx not in slot_set]
 
     if removed_entries:
         save_shop_products(remaining_products)
@@ -328,6 +524,10 @@ def default_games_state():
     }
 
 def load_games_state():
+    """Return the in-memory games state, reading the file only the first time."""
+    global _STATE_CACHE
+    if _STATE_CACHE is not None:
+        return _STATE_CACHE
     state = load_json(GAMES_FILE, default_games_state())
     if not isinstance(state, dict):
         state = default_games_state()
@@ -335,19 +535,61 @@ def load_games_state():
     for key, fallback in defaults.items():
         if not isinstance(state.get(key), list):
             state[key] = fallback
+    # Newest first, capped: appendleft() evicts the oldest entry in O(1)
+    for key in HISTORY_KEYS:
+        state[key] = deque(state[key], maxlen=HISTORY_LIMIT)
+    index_games(state)
+    _STATE_CACHE = state
     return state
 
+def index_games(state):
+    """Rebuild the id and waiting-creator lookups for open dice bets and blackjack matches."""
+    for key in OPEN_GAME_KEYS:
+        _GAME_INDEX[key] = {game.get("id"): game for game in state[key]}
+        _WAITING_BY_CREATOR[key] = {
+            game.get("creator"): game.get("id") for game in state[key] if game.get("status") == "waiting"
+        }
+
+def add_game(state, key, game):
+    state[key].append(game)
+    _GAME_INDEX[key][game["id"]] = game
+    if game.get("status") == "waiting":
+        _WAITING_BY_CREATOR[key][game.get("creator")] = game["id"]
+
+def remove_game(state, key, game):
+    state[key].remove(game)
+    _GAME_INDEX[key].pop(game.get("id"), None)
+    if _WAITING_BY_CREATOR[key].get(game.get("creator")) == game.get("id"):
+        del _WAITING_BY_CREATOR[key][game.get("creator")]
+
 def save_games_state(state):
+    global _STATE_CACHE, _games_version
+    _STATE_CACHE = state
+    _games_version = next(_GAMES_VERSIONS)
     save_json(GAMES_FILE, state)
 
-def valid_secret():
-    return request.headers.get('X-Webhook-Secret', '') == WEBHOOK_SECRET
-
 def now_iso():
-    return datetime.now(timezone.utc).isoformat()
+    """UTC timestamp at millisecond resolution, formatted once per millisecond per thread."""
+    ms = time.time_ns() // 1_000_000
+    cached = getattr(_NOW_CACHE, "value", None)
+    if cached is not None and cached[0] == ms:
+        return cached[1]
+    stamp = datetime.fromtimestamp(ms / 1000, timezone.utc).isoformat(timespec='milliseconds')
+    _NOW_CACHE.value = (ms, stamp)
+    return stamp
 
 def make_id(prefix):
-    return f"{prefix}_{int(datetime.now(timezone.utc).timestamp() * 1000)}_{random.randint(1000, 9999)}"
+    return f"{prefix}_{secrets.token_hex(4).upper()}"
+
+def to_cents(value, default=0):
+    """Convert a dollar amount to integer cents."""
+    try:
+        return round(float(value) * 100)
+    except (TypeError, ValueError):
+        return round(float(default) * 100)
+
+def from_cents(cents):
+    return cents / 100
 
 def as_money(value, default=0.0):
     try:
@@ -355,6 +597,33 @@ def as_money(value, default=0.0):
     except (TypeError, ValueError):
         return round(float(default), 2)
 
+FIELD_PARSERS = {
+    "user": lambda v: str(v).strip().lower(),
+    "text": lambda v: str(v).strip(),
+    "money": as_money,
+}
+
+def request_data():
+    """JSON body of the current request (parsed once, {} when missing or invalid)."""
+    data = request.get_json(cache=True, silent=True)
+    return data if isinstance(data, dict) else {}
+
+def parse_fields(data, spec):
+    """Normalize the (field, kind) pairs of spec from data, returned in spec order."""
+    return [FIELD_PARSERS[kind](data.get(field, "")) for field, kind in spec]
+
+@contextmanager
+def user_locks(*usernames):
+    """Hold the balance locks of the given users; stripes are taken in index order."""
+    stripes = sorted({hash(str(u or "").lower().strip()) % USER_LOCK_STRIPES for u in usernames})
+    for stripe in stripes:
+        USER_LOCKS[stripe].acquire()
+    try:
+        yield
+    finally:
+        for stripe in reversed(stripes):
+            USER_LOCKS[stripe].release()
+
 def ensure_balance_user(balances, username):
     username = str(username or "").lower().strip()
     if username not in balances or not isinstance(balances.get(username), dict):
@@ -366,10 +635,29 @@ def ensure_balance_user(balances, username):
 ADMIN_IDS = load_admins()
 
 # ==================== FLASK APP ====================
+class OrjsonProvider(DefaultJSONProvider):
+    """Serialize jsonify() responses with orjson."""
+    def dumps(self, obj, **kwargs):
+        return dump_json(obj).decode('utf-8')
+
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 # Allow CORS from any origin (needed for GitHub Pages -> Railway)
 CORS(app, resources={r"/api/*": {"origins": "*"}}, supports_credentials=False)
 
+@app.before_request
+def require_webhook_secret():
+    """Reject /api/* calls without the shared secret before any view runs."""
+    if request.method == 'OPTIONS':
+        # CORS preflight: answer here, flask_cors adds the headers on the way out
+        return '', 204
+    if not request.path.startswith('/api/') or request.path in OPEN_API_PATHS:
+        return None
+    secret = request.headers.get('X-Webhook-Secret', '').encode('utf-8')
+    if not hmac.compare_digest(secret, WEBHOOK_SECRET_BYTES):
+        return jsonify({"error": "Unauthorized"}), 401
+    return None
+
 @app.route('/health', methods=['GET'])
 def health_check():
     return jsonify({"status": "ok", "server": "PLUXO API"})
@@ -377,26 +665,25 @@ def health_check():
 @app.route('/api/products', methods=['GET', 'OPTIONS'])
 def get_products():
     """Serve shop products for the website"""
-    if request.method == 'OPTIONS':
-        return '', 204
     try:
-        shop_products = get_shop_products()
-        return jsonify(shop_products)
+        body, etag = get_products_payload()
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+        else:
+            response = Response(body, mimetype='application/json')
+        response.set_etag(etag)
+        # Stock changes on every sale, so clients must revalidate (cheap 304) each time
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
     except Exception as e:
         logger.error(f"Products API error: {e}")
         return jsonify([]), 200  # Return empty array on error
 
 @app.route('/api/register', methods=['POST', 'OPTIONS'])
 def webhook_register():
-    if request.method == 'OPTIONS':
-        return '', 204
     try:
-        secret = request.headers.get('X-Webhook-Secret', '')
-        if secret != WEBHOOK_SECRET:
-            return jsonify({"error": "Unauthorized"}), 401
-        
-        data = request.json
-        username = data.get('username', '').lower().strip()
+        data = request_data()
+        username, = parse_fields(data, (("username", "user"),))
         email = data.get('email', '')
         
         if not username:
@@ -410,7 +697,7 @@ def webhook_register():
                 "balance": 0,
                 "totalRecharge": 0,
                 "email": email,
-                "registeredAt": datetime.now(timezone.utc).isoformat()
+                "registeredAt": now_iso()
             }
             save_balances(balances)
             log_action(0, "WEBSITE", "NEW_USER", f"User registered: {username}")
@@ -423,13 +710,7 @@ def webhook_register():
 
 @app.route('/api/balance/<username>', methods=['GET', 'OPTIONS'])
 def get_user_balance(username):
-    if request.method == 'OPTIONS':
-        return '', 204
     try:
-        secret = request.headers.get('X-Webhook-Secret', '')
-        if secret != WEBHOOK_SECRET:
-            return jsonify({"error": "Unauthorized"}), 401
-        
         username = username.lower().strip()
         balances = load_balances()
         
@@ -449,16 +730,9 @@ def get_user_balance(username):
 
 @app.route('/api/balance/update', methods=['POST', 'OPTIONS'])
 def update_user_balance():
-    if request.method == 'OPTIONS':
-        return '', 204
     try:
-        secret = request.headers.get('X-Webhook-Secret', '')
-        if secret != WEBHOOK_SECRET:
-            return jsonify({"error": "Unauthorized"}), 401
-        
-        data = request.json
-        username = data.get('username', '').lower().strip()
-        action = data.get('action', '')
+        data = request_data()
+        username, action = parse_fields(data, (("username", "user"), ("action", "text")))
         amount = float(data.get('amount', 0))
         
         if not username or not action or amount <= 0:
@@ -490,15 +764,9 @@ def update_user_balance():
 @app.route('/api/purchase/notify', methods=['POST', 'OPTIONS'])
 def notify_purchase():
     """Notify admins about a purchase made on the website"""
-    if request.method == 'OPTIONS':
-        return '', 204
     try:
-        secret = request.headers.get('X-Webhook-Secret', '')
-        if secret != WEBHOOK_SECRET:
-            return jsonify({"error": "Unauthorized"}), 401
-        
-        data = request.json
-        username = data.get('username', '').lower().strip()
+        data = request_data()
+        username, = parse_fields(data, (("username", "user"),))
         item_count = data.get('item_count', 1)
         total_amount = float(data.get('total_amount', 0))
         product_ids = data.get('product_ids', [])
@@ -520,7 +788,7 @@ def notify_purchase():
             removed_count = len(removed_entries)
         
         # Send notification to all admins via Telegram bot (run in background)
-        threading.Thread(target=lambda: asyncio.run(notify_admins_purchase(username, item_count, total_amount)), daemon=True).start()
+        run_in_bot_loop(notify_admins_purchase(username, item_count, total_amount))
         
         return jsonify({
             "success": True,
@@ -536,15 +804,9 @@ def notify_purchase():
 @app.route('/api/purchase/checkout', methods=['POST', 'OPTIONS'])
 def purchase_checkout():
     """Atomically charge balance and remove purchased products from stock."""
-    if request.method == 'OPTIONS':
-        return '', 204
     try:
-        secret = request.headers.get('X-Webhook-Secret', '')
-        if secret != WEBHOOK_SECRET:
-            return jsonify({"error": "Unauthorized"}), 401
-
-        data = request.json or {}
-        username = str(data.get('username', '')).lower().strip()
+        data = request_data()
+        username, = parse_fields(data, (("username", "user"),))
         items = data.get('items', [])
 
         if not username or not isinstance(items, list) or len(items) == 0:
@@ -565,25 +827,28 @@ def purchase_checkout():
         if not product_ids or total_amount <= 0:
             return jsonify({"error": "Invalid checkout items"}), 400
 
-        # 1) Validate user balance
-        balances = load_balances()
-        if username not in balances:
-            balances[username] = {"balance": 0, "totalRecharge": 0}
-        old_balance = float(balances[username].get("balance", 0))
-        if old_balance < total_amount:
-            return jsonify({"error": "Insufficient balance"}), 400
-
-        # 2) Remove products from shared stock first (so they are not sellable anymore)
-        removed_products, missing_ids = remove_shop_products_by_ids(product_ids)
-        if missing_ids:
-            return jsonify({"error": "Some items are no longer available", "missing_ids": missing_ids}), 409
-        if len(removed_products) != len(product_ids):
-            return jsonify({"error": "Checkout failed: product mismatch"}), 409
+        with transaction() as pending:
+            # 1) Validate user balance
+            balances = load_balances()
+            if username not in balances:
+                balances[username] = {"balance": 0, "totalRecharge": 0}
+            old_balance = float(balances[username].get("balance", 0))
+            if old_balance < total_amount:
+                return jsonify({"error": "Insufficient balance"}), 400
 
-        # 3) Charge balance after stock lock-in
-        new_balance = old_balance - total_amount
-        balances[username]["balance"] = new_balance
-        save_balances(balances)
+            # 2) Remove products from shared stock first (so they are not sellable anymore)
+            removed_products, missing_ids = remove_shop_products_by_ids(product_ids)
+            if missing_ids:
+                pending.clear()  # Nothing was sold; leave the stock untouched
+                return jsonify({"error": "Some items are no longer available", "missing_ids": missing_ids}), 409
+            if len(removed_products) != len(product_ids):
+                pending.clear()
+                return jsonify({"error": "Checkout failed: product mismatch"}), 409
+
+            # 3) Charge balance after stock lock-in
+            new_balance = old_balance - total_amount
+            balances[username]["balance"] = new_balance
+            save_balances(balances)
 
         # 4) Return purchased product payload with keys/full info
         purchased_items = []
@@ -625,443 +890,403 @@ def purchase_checkout():
         logger.error(f"Purchase checkout error: {e}")
         return jsonify({"error": str(e)}), 500
 
+def build_completed(game, **results):
+    """Turn an open game (already removed from its list) into its history entry, in place."""
+    game.update(results)
+    game["status"] = "completed"
+    game["completedAt"] = now_iso()
+    return game
+
+def game_endpoint(name):
+    """Wrap a game view so unexpected errors are logged and returned as a 500."""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                logger.error(f"{name} error: {e}")
+                return jsonify({"error": str(e)}), 500
+        return wrapper
+    return decorator
+
+def games_list_response(lock, key, field):
+    """Serve a games list, answering 304 while the games state is unchanged since the client's copy."""
+    with lock:
+        etag = f"{GAMES_EPOCH}-{_games_version}"
+        items = None if request.if_none_match.contains_weak(etag) else list(load_games_state()[key])
+    if items is None:
+        response = Response(status=304)
+    else:
+        response = jsonify({"success": True, field: items})
+    response.set_etag(etag, weak=True)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
 @app.route('/api/games/dice/bets', methods=['GET', 'OPTIONS'])
+@game_endpoint("Dice bets")
 def api_get_dice_bets():
-    if request.method == 'OPTIONS':
-        return '', 204
-    if not valid_secret():
-        return jsonify({"error": "Unauthorized"}), 401
-    with GAMES_LOCK:
-        state = load_games_state()
-        return jsonify({"success": True, "bets": state["dice_bets"]})
+    return games_list_response(DICE_LOCK, "dice_bets", "bets")
 
 @app.route('/api/games/dice/history', methods=['GET', 'OPTIONS'])
+@game_endpoint("Dice history")
 def api_get_dice_history():
-    if request.method == 'OPTIONS':
-        return '', 204
-    if not valid_secret():
-        return jsonify({"error": "Unauthorized"}), 401
-    with GAMES_LOCK:
-        state = load_games_state()
-        return jsonify({"success": True, "history": state["dice_history"]})
+    return games_list_response(DICE_LOCK, "dice_history", "history")
 
 @app.route('/api/games/dice/create', methods=['POST', 'OPTIONS'])
+@game_endpoint("Create dice bet")
 def api_create_dice_bet():
-    if request.method == 'OPTIONS':
-        return '', 204
-    if not valid_secret():
-        return jsonify({"error": "Unauthorized"}), 401
-    try:
-        data = request.json or {}
-        creator = str(data.get("creator", "")).strip().lower()
-        creator_name = str(data.get("creatorName", "")).strip()
-        amount = as_money(data.get("amount", 0))
-        if not creator or not creator_name or amount < 1 or amount > 25:
-            return jsonify({"error": "Invalid parameters"}), 400
+    creator, creator_name, amount = parse_fields(
+        request_data(), (("creator", "user"), ("creatorName", "text"), ("amount", "money"))
+    )
+    if not creator or not creator_name or amount < 1 or amount > 25:
+        return jsonify({"error": "Invalid parameters"}), 400
 
-        with GAMES_LOCK:
-            state = load_games_state()
-            balances = load_balances()
-            creator_data = ensure_balance_user(balances, creator)
-            for bet in state["dice_bets"]:
-                if bet.get("status") == "waiting" and (bet.get("creator") == creator or bet.get("opponent") == creator):
-                    return jsonify({"error": "You already have an active waiting bet"}), 400
+    with DICE_LOCK, user_locks(creator), transaction():
+        state = load_games_state()
+        balances = load_balances()
+        creator_data = ensure_balance_user(balances, creator)
+        if creator in _WAITING_BY_CREATOR["dice_bets"]:
+            return jsonify({"error": "You already have an active waiting bet"}), 400
 
-            if creator_data["balance"] < amount:
-                return jsonify({"error": "Insufficient balance"}), 400
+        if creator_data["balance"] < amount:
+            return jsonify({"error": "Insufficient balance"}), 400
 
-            creator_data["balance"] = as_money(creator_data["balance"] - amount)
-
-            new_bet = {
-                "id": make_id("DICE"),
-                "creator": creator,
-                "creatorName": creator_name,
-                "opponent": None,
-                "opponentName": None,
-                "amount": f"{amount:.2f}",
-                "status": "waiting",
-                "creatorDebited": True,
-                "creatorRoll": None,
-                "opponentRoll": None,
-                "winner": None,
-                "winnerName": None,
-                "createdAt": now_iso(),
-                "completedAt": None
-            }
-            state["dice_bets"].append(new_bet)
-            save_balances(balances)
-            save_games_state(state)
-            return jsonify({"success": True, "bet": new_bet, "newBalance": creator_data["balance"]})
-    except Exception as e:
-        logger.error(f"Create dice bet error: {e}")
-        return jsonify({"error": str(e)}), 500
+        creator_data["balance"] = as_money(creator_data["balance"] - amount)
+
+        new_bet = {
+            "id": make_id("DICE"),
+            "creator": creator,
+            "creatorName": creator_name,
+            "opponent": None,
+            "opponentName": None,
+            "amount": f"{amount:.2f}",
+            "status": "waiting",
+            "creatorDebited": True,
+            "creatorRoll": None,
+            "opponentRoll": None,
+            "winner": None,
+            "winnerName": None,
+            "createdAt": now_iso(),
+            "completedAt": None
+        }
+        add_game(state, "dice_bets", new_bet)
+        save_balances(balances)
+        save_games_state(state)
+        return jsonify({"success": True, "bet": new_bet, "newBalance": creator_data["balance"]})
 
 @app.route('/api/games/dice/cancel', methods=['POST', 'OPTIONS'])
+@game_endpoint("Cancel dice bet")
 def api_cancel_dice_bet():
-    if request.method == 'OPTIONS':
-        return '', 204
-    if not valid_secret():
-        return jsonify({"error": "Unauthorized"}), 401
-    try:
-        data = request.json or {}
-        bet_id = str(data.get("betId", "")).strip()
-        username = str(data.get("username", "")).strip().lower()
-        if not bet_id or not username:
-            return jsonify({"error": "Invalid parameters"}), 400
+    bet_id, username = parse_fields(request_data(), (("betId", "text"), ("username", "user")))
+    if not bet_id or not username:
+        return jsonify({"error": "Invalid parameters"}), 400
 
-        with GAMES_LOCK:
-            state = load_games_state()
-            balances = load_balances()
-            idx = next((i for i, b in enumerate(state["dice_bets"]) if b.get("id") == bet_id), -1)
-            if idx < 0:
-                return jsonify({"error": "Bet not found"}), 404
-            bet = state["dice_bets"][idx]
-            if bet.get("creator") != username:
-                return jsonify({"error": "Only creator can cancel"}), 403
-            if bet.get("status") != "waiting":
-                return jsonify({"error": "Bet cannot be cancelled"}), 400
-            state["dice_bets"].pop(idx)
-            amount = as_money(bet.get("amount", 0))
-            creator_data = ensure_balance_user(balances, username)
-            refunded = 0.0
-            if bet.get("creatorDebited", False):
-                creator_data["balance"] = as_money(creator_data["balance"] + amount)
-                refunded = amount
-            save_balances(balances)
-            save_games_state(state)
-            return jsonify({"success": True, "amount": refunded, "newBalance": creator_data["balance"]})
-    except Exception as e:
-        logger.error(f"Cancel dice bet error: {e}")
-        return jsonify({"error": str(e)}), 500
+    with DICE_LOCK, user_locks(username), transaction():
+        state = load_games_state()
+        balances = load_balances()
+        bet = _GAME_INDEX["dice_bets"].get(bet_id)
+        if bet is None:
+            return jsonify({"error": "Bet not found"}), 404
+        if bet.get("creator") != username:
+            return jsonify({"error": "Only creator can cancel"}), 403
+        if bet.get("status") != "waiting":
+            return jsonify({"error": "Bet cannot be cancelled"}), 400
+        remove_game(state, "dice_bets", bet)
+        amount = as_money(bet.get("amount", 0))
+        creator_data = ensure_balance_user(balances, username)
+        refunded = 0.0
+        if bet.get("creatorDebited", False):
+            creator_data["balance"] = as_money(creator_data["balance"] + amount)
+            refunded = amount
+        save_balances(balances)
+        save_games_state(state)
+        return jsonify({"success": True, "amount": refunded, "newBalance": creator_data["balance"]})
 
 @app.route('/api/games/dice/accept', methods=['POST', 'OPTIONS'])
+@game_endpoint("Accept dice bet")
 def api_accept_dice_bet():
-    if request.method == 'OPTIONS':
-        return '', 204
-    if not valid_secret():
-        return jsonify({"error": "Unauthorized"}), 401
-    try:
-        data = request.json or {}
-        bet_id = str(data.get("betId", "")).strip()
-        opponent = str(data.get("opponent", "")).strip().lower()
-        opponent_name = str(data.get("opponentName", "")).strip()
-        if not bet_id or not opponent or not opponent_name:
-            return jsonify({"error": "Invalid parameters"}), 400
-
-        with GAMES_LOCK:
-            state = load_games_state()
-            balances = load_balances()
-            idx = next((i for i, b in enumerate(state["dice_bets"]) if b.get("id") == bet_id), -1)
-            if idx < 0:
-                return jsonify({"error": "Bet not found"}), 404
-            bet = state["dice_bets"][idx]
-            if bet.get("status") != "waiting":
-                return jsonify({"error": "Bet is no longer available"}), 400
-            if bet.get("creator") == opponent:
-                return jsonify({"error": "Cannot accept your own bet"}), 400
-
-            amount = as_money(bet.get("amount", 0))
-            creator_username = str(bet.get("creator", "")).lower().strip()
-            creator_data = ensure_balance_user(balances, creator_username)
-            opponent_data = ensure_balance_user(balances, opponent)
-
-            # Backward-compatible safety: older matches may not have creator stake debited.
-            if not bet.get("creatorDebited", False):
-                if creator_data["balance"] < amount:
-                    state["dice_bets"].pop(idx)
-                    save_games_state(state)
-                    return jsonify({"error": "Creator has insufficient balance. Match cancelled."}), 409
-                creator_data["balance"] = as_money(creator_data["balance"] - amount)
-                bet["creatorDebited"] = True
-
-            if opponent_data["balance"] < amount:
-                return jsonify({"error": "Insufficient balance"}), 400
-            opponent_data["balance"] = as_money(opponent_data["balance"] - amount)
-
-            creator_roll = random.randint(1, 6)
-            opponent_roll = random.randint(1, 6)
-            winner = "tie"
-            winner_name = "Tie"
-            if creator_roll > opponent_roll:
-                winner = bet.get("creator")
-                winner_name = bet.get("creatorName")
-            elif opponent_roll > creator_roll:
-                winner = opponent
-                winner_name = opponent_name
-
-            creator_payout = 0.0
-            opponent_payout = 0.0
-            if winner == creator_username:
-                creator_payout = as_money(amount * 2)
-                creator_data["balance"] = as_money(creator_data["balance"] + creator_payout)
-            elif winner == opponent:
-                opponent_payout = as_money(amount * 2)
-                opponent_data["balance"] = as_money(opponent_data["balance"] + opponent_payout)
-            else:
-                # Tie: return 50% to each side (house keeps 50% total)
-                creator_payout = as_money(amount * 0.5)
-                opponent_payout = as_money(amount * 0.5)
-                creator_data["balance"] = as_money(creator_data["balance"] + creator_payout)
-                opponent_data["balance"] = as_money(opponent_data["balance"] + opponent_payout)
-
-            completed = {
-                **bet,
-                "opponent": opponent,
-                "opponentName": opponent_name,
-                "status": "completed",
-                "creatorRoll": creator_roll,
-                "opponentRoll": opponent_roll,
-                "winner": winner,
-                "winnerName": winner_name,
-                "creatorPayout": creator_payout,
-                "opponentPayout": opponent_payout,
-                "creatorBalanceAfter": creator_data["balance"],
-                "opponentBalanceAfter": opponent_data["balance"],
-                "completedAt": now_iso()
-            }
+    bet_id, opponent, opponent_name = parse_fields(
+        request_data(), (("betId", "text"), ("opponent", "user"), ("opponentName", "text"))
+    )
+    if not bet_id or not opponent or not opponent_name:
+        return jsonify({"error": "Invalid parameters"}), 400
 
-            state["dice_bets"].pop(idx)
-            state["dice_history"].insert(0, completed)
-            state["dice_history"] = state["dice_history"][:100]
-            save_balances(balances)
+    with DICE_LOCK, transaction(), ExitStack() as held:
+        state = load_games_state()
+        balances = load_balances()
+        bet = _GAME_INDEX["dice_bets"].get(bet_id)
+        if bet is None:
+            return jsonify({"error": "Bet not found"}), 404
+        if bet.get("status") != "waiting":
+            return jsonify({"error": "Bet is no longer available"}), 400
+        if bet.get("creator") == opponent:
+            return jsonify({"error": "Cannot accept your own bet"}), 400
+
+        amount_cents = to_cents(bet.get("amount", 0))
+        creator_username = str(bet.get("creator", "")).lower().strip()
+        held.enter_context(user_locks(creator_username, opponent))
+        creator_data = ensure_balance_user(balances, creator_username)
+        opponent_data = ensure_balance_user(balances, opponent)
+        # Settle in integer cents; shared balances are written back once at the end
+        creator_cents = to_cents(creator_data["balance"])
+        opponent_cents = to_cents(opponent_data["balance"])
+
+        # Backward-compatible safety: older matches may not have creator stake debited.
+        creator_needs_debit = not bet.get("creatorDebited", False)
+        if creator_needs_debit and creator_cents < amount_cents:
+            remove_game(state, "dice_bets", bet)
             save_games_state(state)
-            return jsonify({
-                "success": True,
-                "result": completed,
-                "balances": {
-                    "creator": creator_data["balance"],
-                    "opponent": opponent_data["balance"]
-                },
-                "viewerBalance": opponent_data["balance"]
-            })
-    except Exception as e:
-        logger.error(f"Accept dice bet error: {e}")
-        return jsonify({"error": str(e)}), 500
+            return jsonify({"error": "Creator has insufficient balance. Match cancelled."}), 409
+
+        if opponent_cents < amount_cents:
+            return jsonify({"error": "Insufficient balance"}), 400
+        if creator_needs_debit:
+            creator_cents -= amount_cents
+            bet["creatorDebited"] = True
+        opponent_cents -= amount_cents
+
+        creator_roll = random.randint(1, 6)
+        opponent_roll = random.randint(1, 6)
+        winner = "tie"
+        winner_name = "Tie"
+        if creator_roll > opponent_roll:
+            winner = bet.get("creator")
+            winner_name = bet.get("creatorName")
+        elif opponent_roll > creator_roll:
+            winner = opponent
+            winner_name = opponent_name
+
+        creator_payout_cents = 0
+        opponent_payout_cents = 0
+        if winner == creator_username:
+            creator_payout_cents = amount_cents * 2
+        elif winner == opponent:
+            opponent_payout_cents = amount_cents * 2
+        else:
+            # Tie: return 50% to each side (house keeps 50% total)
+            creator_payout_cents = opponent_payout_cents = amount_cents >> 1
+        creator_payout = from_cents(creator_payout_cents)
+        opponent_payout = from_cents(opponent_payout_cents)
+        creator_data["balance"] = from_cents(creator_cents + creator_payout_cents)
+        opponent_data["balance"] = from_cents(opponent_cents + opponent_payout_cents)
+
+        remove_game(state, "dice_bets", bet)
+        completed = build_completed(
+            bet,
+            opponent=opponent,
+            opponentName=opponent_name,
+            creatorRoll=creator_roll,
+            opponentRoll=opponent_roll,
+            winner=winner,
+            winnerName=winner_name,
+            creatorPayout=creator_payout,
+            opponentPayout=opponent_payout,
+            creatorBalanceAfter=creator_data["balance"],
+            opponentBalanceAfter=opponent_data["balance"],
+        )
+        state["dice_history"].appendleft(completed)
+        save_balances(balances)
+        save_games_state(state)
+        return jsonify({
+            "success": True,
+            "result": completed,
+            "balances": {
+                "creator": creator_data["balance"],
+                "opponent": opponent_data["balance"]
+            },
+            "viewerBalance": opponent_data["balance"]
+        })
 
 @app.route('/api/games/blackjack/matches', methods=['GET', 'OPTIONS'])
+@game_endpoint("Blackjack matches")
 def api_get_blackjack_matches():
-    if request.method == 'OPTIONS':
-        return '', 204
-    if not valid_secret():
-        return jsonify({"error": "Unauthorized"}), 401
-    with GAMES_LOCK:
-        state = load_games_state()
-        return jsonify({"success": True, "matches": state["blackjack_matches"]})
+    return games_list_response(BLACKJACK_LOCK, "blackjack_matches", "matches")
 
 @app.route('/api/games/blackjack/history', methods=['GET', 'OPTIONS'])
+@game_endpoint("Blackjack history")
 def api_get_blackjack_history():
-    if request.method == 'OPTIONS':
-        return '', 204
-    if not valid_secret():
-        return jsonify({"error": "Unauthorized"}), 401
-    with GAMES_LOCK:
-        state = load_games_state()
-        return jsonify({"success": True, "history": state["blackjack_history"]})
+    return games_list_response(BLACKJACK_LOCK, "blackjack_history", "history")
 
 @app.route('/api/games/blackjack/create', methods=['POST', 'OPTIONS'])
+@game_endpoint("Create blackjack match")
 def api_create_blackjack_match():
-    if request.method == 'OPTIONS':
-        return '', 204
-    if not valid_secret():
-        return jsonify({"error": "Unauthorized"}), 401
-    try:
-        data = request.json or {}
-        creator = str(data.get("creator", "")).strip().lower()
-        creator_name = str(data.get("creatorName", "")).strip()
-        amount = as_money(data.get("amount", 0))
-        if not creator or not creator_name or amount < 1 or amount > 25:
-            return jsonify({"error": "Invalid parameters"}), 400
+    creator, creator_name, amount = parse_fields(
+        request_data(), (("creator", "user"), ("creatorName", "text"), ("amount", "money"))
+    )
+    if not creator or not creator_name or amount < 1 or amount > 25:
+        return jsonify({"error": "Invalid parameters"}), 400
 
-        with GAMES_LOCK:
-            state = load_games_state()
-            balances = load_balances()
-            creator_data = ensure_balance_user(balances, creator)
-            existing = next((m for m in state["blackjack_matches"] if m.get("creator") == creator and m.get("status") == "waiting"), None)
-            if existing:
-                return jsonify({"error": "You already have an open match"}), 400
+    with BLACKJACK_LOCK, user_locks(creator), transaction():
+        state = load_games_state()
+        balances = load_balances()
+        creator_data = ensure_balance_user(balances, creator)
+        if creator in _WAITING_BY_CREATOR["blackjack_matches"]:
+            return jsonify({"error": "You already have an open match"}), 400
 
-            if creator_data["balance"] < amount:
-                return jsonify({"error": "Insufficient balance"}), 400
-            creator_data["balance"] = as_money(creator_data["balance"] - amount)
-
-            match = {
-                "id": make_id("BJ"),
-                "creator": creator,
-                "creatorName": creator_name,
-                "opponent": None,
-                "opponentName": None,
-                "amount": f"{amount:.2f}",
-                "status": "waiting",
-                "creatorDebited": True,
-                "createdAt": now_iso()
-            }
-            state["blackjack_matches"].append(match)
-            save_balances(balances)
-            save_games_state(state)
-            return jsonify({"success": True, "match": match, "newBalance": creator_data["balance"]})
-    except Exception as e:
-        logger.error(f"Create blackjack match error: {e}")
-        return jsonify({"error": str(e)}), 500
+        if creator_data["balance"] < amount:
+            return jsonify({"error": "Insufficient balance"}), 400
+        creator_data["balance"] = as_money(creator_data["balance"] - amount)
+
+        match = {
+            "id": make_id("BJ"),
+            "creator": creator,
+            "creatorName": creator_name,
+            "opponent": None,
+            "opponentName": None,
+            "amount": f"{amount:.2f}",
+            "status": "waiting",
+            "creatorDebited": True,
+            "createdAt": now_iso()
+        }
+        add_game(state, "blackjack_matches", match)
+        save_balances(balances)
+        save_games_state(state)
+        return jsonify({"success": True, "match": match, "newBalance": creator_data["balance"]})
 
 @app.route('/api/games/blackjack/cancel', methods=['POST', 'OPTIONS'])
+@game_endpoint("Cancel blackjack match")
 def api_cancel_blackjack_match():
-    if request.method == 'OPTIONS':
-        return '', 204
-    if not valid_secret():
-        return jsonify({"error": "Unauthorized"}), 401
-    try:
-        data = request.json or {}
-        match_id = str(data.get("matchId", "")).strip()
-        username = str(data.get("username", "")).strip().lower()
-        if not match_id or not username:
-            return jsonify({"error": "Invalid parameters"}), 400
+    match_id, username = parse_fields(request_data(), (("matchId", "text"), ("username", "user")))
+    if not match_id or not username:
+        return jsonify({"error": "Invalid parameters"}), 400
 
-        with GAMES_LOCK:
-            state = load_games_state()
-            balances = load_balances()
-            idx = next((i for i, m in enumerate(state["blackjack_matches"]) if m.get("id") == match_id), -1)
-            if idx < 0:
-                return jsonify({"error": "Match not found"}), 404
-            match = state["blackjack_matches"][idx]
-            if match.get("creator") != username:
-                return jsonify({"error": "Only creator can cancel"}), 403
-            if match.get("status") != "waiting":
-                return jsonify({"error": "Match cannot be cancelled"}), 400
-
-            state["blackjack_matches"].pop(idx)
-            amount = as_money(match.get("amount", 0))
-            creator_data = ensure_balance_user(balances, username)
-            refunded = 0.0
-            if match.get("creatorDebited", False):
-                creator_data["balance"] = as_money(creator_data["balance"] + amount)
-                refunded = amount
-            save_balances(balances)
-            save_games_state(state)
-            return jsonify({"success": True, "amount": refunded, "newBalance": creator_data["balance"]})
-    except Exception as e:
-        logger.error(f"Cancel blackjack match error: {e}")
-        return jsonify({"error": str(e)}), 500
+    with BLACKJACK_LOCK, user_locks(username), transaction():
+        state = load_games_state()
+        balances = load_balances()
+        match = _GAME_INDEX["blackjack_matches"].get(match_id)
+        if match is None:
+            return jsonify({"error": "Match not found"}), 404
+        if match.get("creator") != username:
+            return jsonify({"error": "Only creator can cancel"}), 403
+        if match.get("status") != "waiting":
+            return jsonify({"error": "Match cannot be cancelled"}), 400
+
+        remove_game(state, "blackjack_matches", match)
+        amount = as_money(match.get("amount", 0))
+        creator_data = ensure_balance_user(balances, username)
+        refunded = 0.0
+        if match.get("creatorDebited", False):
+            creator_data["balance"] = as_money(creator_data["balance"] + amount)
+            refunded = amount
+        save_balances(balances)
+        save_games_state(state)
+        return jsonify({"success": True, "amount": refunded, "newBalance": creator_data["balance"]})
 
 @app.route('/api/games/blackjack/join', methods=['POST', 'OPTIONS'])
+@game_endpoint("Join blackjack match")
 def api_join_blackjack_match():
-    if request.method == 'OPTIONS':
-        return '', 204
-    if not valid_secret():
-        return jsonify({"error": "Unauthorized"}), 401
-    try:
-        data = request.json or {}
-        match_id = str(data.get("matchId", "")).strip()
-        opponent = str(data.get("opponent", "")).strip().lower()
-        opponent_name = str(data.get("opponentName", "")).strip()
-        if not match_id or not opponent or not opponent_name:
-            return jsonify({"error": "Invalid parameters"}), 400
-
-        with GAMES_LOCK:
-            state = load_games_state()
-            balances = load_balances()
-            idx = next((i for i, m in enumerate(state["blackjack_matches"]) if m.get("id") == match_id), -1)
-            if idx < 0:
-                return jsonify({"error": "Match not found"}), 404
-            match = state["blackjack_matches"][idx]
-            if match.get("status") != "waiting":
-                return jsonify({"error": "Match not available"}), 400
-            if match.get("creator") == opponent:
-                return jsonify({"error": "Cannot join your own match"}), 400
-
-            amount = as_money(match.get("amount", 0))
-            creator_username = str(match.get("creator", "")).lower().strip()
-            creator_data = ensure_balance_user(balances, creator_username)
-            opponent_data = ensure_balance_user(balances, opponent)
-
-            # Backward-compatible safety for old waiting matches.
-            if not match.get("creatorDebited", False):
-                if creator_data["balance"] < amount:
-                    state["blackjack_matches"].pop(idx)
-                    save_games_state(state)
-                    return jsonify({"error": "Creator has insufficient balance. Match cancelled."}), 409
-                creator_data["balance"] = as_money(creator_data["balance"] - amount)
-                match["creatorDebited"] = True
-
-            if opponent_data["balance"] < amount:
-                return jsonify({"error": "Insufficient balance"}), 400
-            opponent_data["balance"] = as_money(opponent_data["balance"] - amount)
-
-            creator_score = random.randint(12, 22)
-            opponent_score = random.randint(12, 22)
-            creator_bust = creator_score > 21
-            opponent_bust = opponent_score > 21
-
-            winner = "tie"
-            winner_name = "Tie"
-            if creator_bust and opponent_bust:
-                winner = "tie"
-                winner_name = "Tie"
-            elif creator_bust:
-                winner = opponent
-                winner_name = opponent_name
-            elif opponent_bust:
-                winner = match.get("creator")
-                winner_name = match.get("creatorName")
-            elif creator_score > opponent_score:
-                winner = match.get("creator")
-                winner_name = match.get("creatorName")
-            elif opponent_score > creator_score:
-                winner = opponent
-                winner_name = opponent_name
-
-            creator_payout = 0.0
-            opponent_payout = 0.0
-            if winner == creator_username:
-                creator_payout = as_money(amount * 2)
-                creator_data["balance"] = as_money(creator_data["balance"] + creator_payout)
-            elif winner == opponent:
-                opponent_payout = as_money(amount * 2)
-                opponent_data["balance"] = as_money(opponent_data["balance"] + opponent_payout)
-            else:
-                # Tie: return 50% to each side (house keeps 50% total)
-                creator_payout = as_money(amount * 0.5)
-                opponent_payout = as_money(amount * 0.5)
-                creator_data["balance"] = as_money(creator_data["balance"] + creator_payout)
-                opponent_data["balance"] = as_money(opponent_data["balance"] + opponent_payout)
-
-            completed = {
-                **match,
-                "opponent": opponent,
-                "opponentName": opponent_name,
-                "creatorScore": creator_score,
-                "opponentScore": opponent_score,
-                "winner": winner,
-                "winnerName": winner_name,
-                "creatorPayout": creator_payout,
-                "opponentPayout": opponent_payout,
-                "creatorBalanceAfter": creator_data["balance"],
-                "opponentBalanceAfter": opponent_data["balance"],
-                "status": "completed",
-                "completedAt": now_iso()
-            }
+    match_id, opponent, opponent_name = parse_fields(
+        request_data(), (("matchId", "text"), ("opponent", "user"), ("opponentName", "text"))
+    )
+    if not match_id or not opponent or not opponent_name:
+        return jsonify({"error": "Invalid parameters"}), 400
 
-            state["blackjack_matches"].pop(idx)
-            state["blackjack_history"].insert(0, completed)
-            state["blackjack_history"] = state["blackjack_history"][:100]
-            save_balances(balances)
+    with BLACKJACK_LOCK, transaction(), ExitStack() as held:
+        state = load_games_state()
+        balances = load_balances()
+        match = _GAME_INDEX["blackjack_matches"].get(match_id)
+        if match is None:
+            return jsonify({"error": "Match not found"}), 404
+        if match.get("status") != "waiting":
+            return jsonify({"error": "Match not available"}), 400
+        if match.get("creator") == opponent:
+            return jsonify({"error": "Cannot join your own match"}), 400
+
+        amount_cents = to_cents(match.get("amount", 0))
+        creator_username = str(match.get("creator", "")).lower().strip()
+        held.enter_context(user_locks(creator_username, opponent))
+        creator_data = ensure_balance_user(balances, creator_username)
+        opponent_data = ensure_balance_user(balances, opponent)
+        # Settle in integer cents; shared balances are written back once at the end
+        creator_cents = to_cents(creator_data["balance"])
+        opponent_cents = to_cents(opponent_data["balance"])
+
+        # Backward-compatible safety for old waiting matches.
+        creator_needs_debit = not match.get("creatorDebited", False)
+        if creator_needs_debit and creator_cents < amount_cents:
+            remove_game(state, "blackjack_matches", match)
             save_games_state(state)
-            return jsonify({
-                "success": True,
-                "result": completed,
-                "balances": {
-                    "creator": creator_data["balance"],
-                    "opponent": opponent_data["balance"]
-                },
-                "viewerBalance": opponent_data["balance"]
-            })
-    except Exception as e:
-        logger.error(f"Join blackjack match error: {e}")
-        return jsonify({"error": str(e)}), 500
+            return jsonify({"error": "Creator has insufficient balance. Match cancelled."}), 409
+
+        if opponent_cents < amount_cents:
+            return jsonify({"error": "Insufficient balance"}), 400
+        if creator_needs_debit:
+            creator_cents -= amount_cents
+            match["creatorDebited"] = True
+        opponent_cents -= amount_cents
+
+        creator_score = random.randint(12, 22)
+        opponent_score = random.randint(12, 22)
+        creator_bust = creator_score > 21
+        opponent_bust = opponent_score > 21
+
+        # Outcome: 1 creator wins, -1 opponent wins, 0 tie. Busts decide first
+        # (index = creator_bust << 1 | opponent_bust), otherwise the higher score wins.
+        score_cmp = (creator_score > opponent_score) - (creator_score < opponent_score)
+        outcome = (score_cmp, 1, -1, 0)[(creator_bust << 1) | opponent_bust]
+        winner, winner_name = {
+            1: (match.get("creator"), match.get("creatorName")),
+            -1: (opponent, opponent_name),
+            0: ("tie", "Tie"),
+        }[outcome]
+
+        creator_payout_cents = 0
+        opponent_payout_cents = 0
+        if winner == creator_username:
+            creator_payout_cents = amount_cents * 2
+        elif winner == opponent:
+            opponent_payout_cents = amount_cents * 2
+        else:
+            # Tie: return 50% to each side (house keeps 50% total)
+            creator_payout_cents = opponent_payout_cents = amount_cents >> 1
+        creator_payout = from_cents(creator_payout_cents)
+        opponent_payout = from_cents(opponent_payout_cents)
+        creator_data["balance"] = from_cents(creator_cents + creator_payout_cents)
+        opponent_data["balance"] = from_cents(opponent_cents + opponent_payout_cents)
+
+        remove_game(state, "blackjack_matches", match)
+        completed = build_completed(
+            match,
+            opponent=opponent,
+            opponentName=opponent_name,
+            creatorScore=creator_score,
+            opponentScore=opponent_score,
+            winner=winner,
+            winnerName=winner_name,
+            creatorPayout=creator_payout,
+            opponentPayout=opponent_payout,
+            creatorBalanceAfter=creator_data["balance"],
+            opponentBalanceAfter=opponent_data["balance"],
+        )
+        state["blackjack_history"].appendleft(completed)
+        save_balances(balances)
+        save_games_state(state)
+        return jsonify({
+            "success": True,
+            "result": completed,
+            "balances": {
+                "creator": creator_data["balance"],
+                "opponent": opponent_data["balance"]
+            },
+            "viewerBalance": opponent_data["balance"]
+        })
+
+def run_in_bot_loop(coro):
+    """Schedule a coroutine on the bot's event loop without blocking the request thread."""
+    loop = BOT_LOOP
+    if loop is not None and loop.is_running():
+        return asyncio.run_coroutine_threadsafe(coro, loop)
+    # Bot loop not up (yet): fall back to a throwaway loop in the background
+    threading.Thread(target=asyncio.run, args=(coro,), daemon=True).start()
+    return None
 
 async def notify_admins_purchase(username, item_count, total_amount):
     """Send purchase notification to all admins"""
     try:
-        bot = Bot(token=BOT_TOKEN)
+        # Reuse the application's bot (and its HTTP connection pool) on the bot loop;
+        # only the fallback throwaway loop needs its own instance.
+        bot = TG_BOT if TG_BOT is not None and asyncio.get_running_loop() is BOT_LOOP else Bot(token=BOT_TOKEN)
         purchase_time = datetime.now(timezone.utc)
         date_str = purchase_time.strftime('%Y-%m-%d')
         time_str = purchase_time.strftime('%H:%M:%S UTC')
@@ -1075,11 +1300,14 @@ async def notify_admins_purchase(username, item_count, total_amount):
 🕐 Time: {time_str}
 ━━━━━━━━━━━━━━━━━━"""
         
-        for admin_id in ADMIN_IDS:
-            try:
-                await bot.send_message(chat_id=admin_id, text=message, parse_mode='Markdown')
-            except Exception as e:
-                logger.error(f"Failed to notify admin {admin_id}: {e}")
+        admin_ids = list(ADMIN_IDS)
+        results = await asyncio.gather(
+            *(bot.send_message(chat_id=admin_id, text=message, parse_mode='Markdown') for admin_id in admin_ids),
+            return_exceptions=True,
+        )
+        for admin_id, result in zip(admin_ids, results):
+            if isinstance(result, Exception):
+                logger.error(f"Failed to notify admin {admin_id}: {result}")
     except Exception as e:
         logger.error(f"Error sending purchase notification: {e}")
 
@@ -1172,7 +1400,7 @@ async def set_balance(update: Update, context: ContextTypes.DEFAULT_TYPE):
     balances = load_balances()
     old_balance = balances.get(username, {}).get("balance", 0)
     if username not in balances:
-        balances[username] = {"balance": 0, "totalRecharge": 0, "registeredAt": datetime.now(timezone.utc).isoformat()}
+        balances[username] = {"balance": 0, "totalRecharge": 0, "registeredAt": now_iso()}
     balances[username]["balance"] = amount
     save_balances(balances)
     user = update.effective_user
@@ -1192,7 +1420,7 @@ async def add_balance(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     balances = load_balances()
     if username not in balances:
-        balances[username] = {"balance": 0, "totalRecharge": 0, "registeredAt": datetime.now(timezone.utc).isoformat()}
+        balances[username] = {"balance": 0, "totalRecharge": 0, "registeredAt": now_iso()}
     old_balance = balances[username].get("balance", 0)
     new_balance = old_balance + amount
     balances[username]["balance"] = new_balance
@@ -1241,12 +1469,13 @@ async def list_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not balances:
         await update.message.reply_text("📭 No users registered yet.")
         return
-    msg = "👥 **Registered Users**\n━━━━━━━━━━━━━━━━━━\n"
-    for i, (username, data) in enumerate(balances.items(), 1):
-        balance = data.get("balance", 0)
-        reg_date = data.get("registeredAt", "Unknown")[:10]
-        msg += f"{i}. `{username}` - ${balance:.2f} ({reg_date})\n"
-    msg += f"\n📊 Total Users: {len(balances)}"
+    # Snapshot first: the API threads may add users while we format
+    users = list(balances.items())
+    lines = [
+        f"{i}. `{username}` - ${data.get('balance', 0):.2f} ({data.get('registeredAt', 'Unknown')[:10]})"
+        for i, (username, data) in enumerate(users, 1)
+    ]
+    msg = "👥 **Registered Users**\n━━━━━━━━━━━━━━━━━━\n" + "\n".join(lines) + f"\n\n📊 Total Users: {len(users)}"
     await update.message.reply_text(msg, parse_mode='Markdown')
 
 @owner_only
@@ -1376,14 +1605,13 @@ This will create a product with:
             await update.message.reply_text(f"❌ Invalid key format! Key must be alphanumeric and at least 8 characters. Got: `{cleaned_key}` (length: {len(cleaned_key)})", parse_mode='Markdown')
             return
     
-    # Load existing shop products
-    shop_products = get_shop_products()
+    # Load existing shop products and their key index
+    shop_products, existing_keys = get_shop_catalog()
     
     # Get next ID
     next_id = max([p.get('id', 0) for p in shop_products], default=0) + 1
     
     # Use provided key or generate unique key
-    existing_keys = {p.get('key', '') for p in shop_products}
     if provided_key:
         # Check if key already exists
         if provided_key in existing_keys:
@@ -1428,9 +1656,10 @@ This will create a product with:
     }
     
     shop_products.append(product_entry)
+    existing_keys.add(key)
     
     # Save shop products
-    save_shop_products(shop_products)
+    save_shop_products(shop_products, existing_keys)
     
     # Build response
     masked_display = bin_str + "**********"
@@ -1589,18 +1818,28 @@ def run_bot():
         await application.initialize()
         await application.start()
         await application.updater.start_polling(drop_pending_updates=True)
+        global TG_BOT
+        TG_BOT = application.bot
         
         # Keep running
         while True:
             await asyncio.sleep(3600)
     
+    global BOT_LOOP
     loop = asyncio.new_event_loop()
     asyncio.set_event_loop(loop)
+    BOT_LOOP = loop
     loop.run_until_complete(main())
 
 # ==================== MAIN ====================
 ensure_data_dir()
 
+# Prime the in-memory state before any request or bot thread can race to load it
+load_balances()
+load_games_state()
+threading.Thread(target=state_writer, daemon=True, name="state-writer").start()
+atexit.register(flush_dirty)
+
 # Start bot in background thread when module loads (works with gunicorn)
 # Use a flag to prevent multiple starts
 _bot_started = False